@@ -1 +1 @@
-from .commit_mixin import Session, SessionMixin, CommitMixin
+from .commit_mixin import Session, SessionMixin, CommitMixin, ShedPolicy
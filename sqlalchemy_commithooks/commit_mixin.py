@@ -1,11 +1,18 @@
+import importlib
+import logging
+import random
 import sqlalchemy
-from collections import defaultdict
+from collections import Counter, defaultdict, namedtuple
 from contextlib import contextmanager
+from concurrent.futures import wait
+from time import monotonic
 
 from sqlalchemy import event
 from sqlalchemy.orm import object_session
 from sqlalchemy.orm.session import SessionTransaction
 
+logger = logging.getLogger(__name__)
+
 
 def _build_add_func(time, action):
     # time = before/after/failed
@@ -24,7 +31,17 @@ class CommitMixin:
     Combinations: (before/after/failed)_commit_from_(insert/update/delete)
 
     These methods will automatically be called around commit time.
+
+    Set commit_priority on the class to order hooks; higher priorities run
+    first. Hooks below a session's ShedPolicy priority may be dropped when
+    the session is overloaded.
+
+    Set commit_process_columns to a tuple of column names to run after_commit
+    hooks in a session's process_executor. The hook runs on a transient copy
+    holding only the primary key and those columns, without a session.
     """
+    commit_priority = 0
+    commit_process_columns = None
 
     def __init_subclass__(cls, **kwargs):
         cls._register_hooks(cls._overridden_hooks())
@@ -85,6 +102,89 @@ class CommitMixin:
         raise NotImplemented(self.__err)
 
 
+class ShedPolicy:
+    """
+    Drops or samples low priority after_commit hooks when commit hooks back up.
+    before_commit and failed_commit hooks are never shed.
+
+    Hooks whose commit_priority is below `priority` may be shed once more than
+    `max_pending` hooks are queued for a commit, or once dispatch has taken
+    more than `max_dispatch_time` seconds. `sample_rate` is the fraction of
+    sheddable hooks that still run; 0 drops them all.
+
+    Shed hooks are counted in `shed`, keyed by hook name.
+    """
+
+    def __init__(self, priority=0, max_pending=None, max_dispatch_time=None,
+                 sample_rate=0.0):
+        self.priority = priority
+        self.max_pending = max_pending
+        self.max_dispatch_time = max_dispatch_time
+        self.sample_rate = sample_rate
+        self.shed = Counter()
+
+    def overloaded(self, pending, elapsed):
+        if self.max_pending is not None and pending > self.max_pending:
+            return True
+        if self.max_dispatch_time is not None and elapsed > self.max_dispatch_time:
+            return True
+        return False
+
+    def should_shed(self, hook, priority, pending, elapsed):
+        if priority >= self.priority or not self.overloaded(pending, elapsed):
+            return False
+        if self.sample_rate > 0 and random.random() < self.sample_rate:
+            return False
+        self.shed[hook] += 1
+        return True
+
+
+def _commit_priority(obj):
+    # objects that aren't CommitMixin instances default to 0
+    return getattr(type(obj), 'commit_priority', 0)
+
+
+def _process_columns(obj):
+    return getattr(type(obj), 'commit_process_columns', None)
+
+
+_HookPayload = namedtuple('_HookPayload', 'class_path identity action values')
+
+
+def _build_payload(obj, action):
+    cls = type(obj)
+    values = {key: getattr(obj, key) for key in cls.commit_process_columns}
+    return _HookPayload(f'{cls.__module__}:{cls.__qualname__}',
+                        sqlalchemy.inspect(obj).identity, action, values)
+
+
+def _run_payload(payload):
+    """
+    Runs in a worker process: rebuild a transient object from the payload
+    and call its after_commit hook. __init__ is not called, so only the
+    primary key and commit_process_columns are set.
+    """
+    module, qualname = payload.class_path.split(':')
+    cls = importlib.import_module(module)
+    for name in qualname.split('.'):
+        cls = getattr(cls, name)
+
+    mapper = sqlalchemy.inspect(cls)
+    obj = mapper.class_manager.new_instance()
+    for column, value in zip(mapper.primary_key, payload.identity or ()):
+        setattr(obj, mapper.get_property_by_column(column).key, value)
+    for key, value in payload.values.items():
+        setattr(obj, key, value)
+    return getattr(obj, f'after_commit_from_{payload.action}')()
+
+
+def _log_hook_failure(future):
+    # worker exceptions can't propagate out of commit(); don't lose them
+    if not future.cancelled() and future.exception() is not None:
+        logger.error('after_commit hook failed in worker process',
+                     exc_info=future.exception())
+
+
 class _CommitObjects:
     def __init__(self):
         self.lock = False
@@ -131,11 +231,24 @@ class SessionMixin:
     It must come before sqlalchemy.SessionMixin in the inheritance list to
     override __init__, as sqlalchemy.Session doesn't call super(). The class
     will raise an exception on insertion if such a condition is detected.
+
+    Pass shed_policy (a ShedPolicy) to drop low priority hooks under load.
+
+    Pass process_executor (e.g. a ProcessPoolExecutor) to run after_commit
+    hooks of classes with commit_process_columns in it. Their futures collect
+    in hook_futures until drain_hook_futures is called; failures are logged.
     """
     transaction = None
+    shed_policy = None
+    process_executor = None
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, shed_policy=None, process_executor=None, **kwargs):
         self._commit_objects = _CommitObjects()
+        if shed_policy is not None:
+            self.shed_policy = shed_policy
+        if process_executor is not None:
+            self.process_executor = process_executor
+        self.hook_futures = []
         self._after_failed_commit_active = False
         super().__init__(*args, **kwargs)
 
@@ -209,17 +322,52 @@ class SessionMixin:
         self._commit_objects.after.clear()
         self._commit_objects.lock = False
 
+    def drain_hook_futures(self):
+        """
+        Waits for hooks submitted to process_executor and returns their
+        futures, clearing hook_futures.
+        """
+        futures, self.hook_futures = self.hook_futures, []
+        wait(futures)
+        return futures
+
     def _do_commits(self, time):
         """
-        Executes commit hooks. All inserts are processed first, then
-        all updates, then all deletes.
+        Executes commit hooks, highest commit_priority first. Within a
+        priority, all inserts are processed first, then all updates, then
+        all deletes.
+
+        after_commit hooks of classes with commit_process_columns are
+        submitted to process_executor instead of being called inline.
         """
         objects = getattr(self._commit_objects, time)
-        for type_ in ['insert', 'update', 'delete']:
-            func = f'{time}_commit_from_{type_}'
-            for obj in objects:
-                if type_ in objects[obj]:
-                    getattr(obj, func)()
+        # only deferrable after_commit hooks may be shed
+        policy = self.shed_policy if time == 'after' else None
+        executor = self.process_executor if time == 'after' else None
+        pending = sum(len(actions) for actions in objects.values())
+        start = monotonic()
+
+        by_priority = defaultdict(list)
+        for obj in objects:
+            by_priority[_commit_priority(obj)].append(obj)
+
+        for priority in sorted(by_priority, reverse=True):
+            for type_ in ['insert', 'update', 'delete']:
+                func = f'{time}_commit_from_{type_}'
+                for obj in by_priority[priority]:
+                    if type_ not in objects[obj]:
+                        continue
+                    if policy is not None and policy.should_shed(
+                            func, priority, pending, monotonic() - start):
+                        continue
+                    if executor is not None and \
+                            _process_columns(obj) is not None:
+                        future = executor.submit(
+                            _run_payload, _build_payload(obj, type_))
+                        future.add_done_callback(_log_hook_failure)
+                        self.hook_futures.append(future)
+                    else:
+                        getattr(obj, func)()
         objects.clear()
 
 
@@ -1,8 +1,10 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
 from contextlib import contextmanager
 
 import pytest
 from mock import Mock
-from sqlalchemy import Column, Integer
+from sqlalchemy import Column, Integer, String
 from sqlalchemy import create_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
@@ -181,6 +183,98 @@ class TestAddCommitObject:
         assert len(obj.method_calls) == 1
 
 
+class TestPriorityAndShedding:
+    class FakeSession(commit_mixin.Session):
+        transaction = "transaction"
+
+        @classmethod
+        def _register_commit_hooks(cls):
+            pass
+
+    class Low(Mock):
+        commit_priority = -1
+
+    class High(Mock):
+        commit_priority = 10
+
+    @pytest.fixture(autouse=True)
+    def patch_tmp_transaction(self, monkeypatch):
+        monkeypatch.setattr(commit_mixin, '_tmp_transaction', _tmp_transaction_patch)
+
+    def get_objects(self, session, calls, time='after'):
+        low, high = self.Low(), self.High()
+        getattr(low, f'{time}_commit_from_insert').side_effect = \
+            lambda: calls.append('low')
+        getattr(high, f'{time}_commit_from_update').side_effect = \
+            lambda: calls.append('high')
+        add = getattr(session, f'_add_{time}_commit_object')
+        add(low, 'insert')
+        add(high, 'update')
+        return low, high
+
+    def test_priority_order(self):
+        session = self.FakeSession()
+        calls = []
+        self.get_objects(session, calls)
+        session._do_after_commits()
+        assert calls == ['high', 'low']
+
+    def test_not_overloaded(self):
+        policy = commit_mixin.ShedPolicy(max_pending=2)
+        session = self.FakeSession(shed_policy=policy)
+        calls = []
+        self.get_objects(session, calls)
+        session._do_after_commits()
+        assert calls == ['high', 'low']
+        assert not policy.shed
+
+    def test_shed_max_pending(self):
+        policy = commit_mixin.ShedPolicy(max_pending=1)
+        session = self.FakeSession(shed_policy=policy)
+        calls = []
+        self.get_objects(session, calls)
+        session._do_after_commits()
+        assert calls == ['high']
+        assert policy.shed == {'after_commit_from_insert': 1}
+
+    def test_shed_max_dispatch_time(self, monkeypatch):
+        # 0 at the start of dispatch, well past the threshold afterwards
+        readings = []
+
+        def clock():
+            readings.append(None)
+            return 0 if len(readings) == 1 else 100
+
+        monkeypatch.setattr(commit_mixin, 'monotonic', clock)
+        policy = commit_mixin.ShedPolicy(max_dispatch_time=1)
+        session = self.FakeSession(shed_policy=policy)
+        calls = []
+        self.get_objects(session, calls)
+        session._do_after_commits()
+        assert calls == ['high']
+        assert policy.shed == {'after_commit_from_insert': 1}
+
+    def test_sampled(self, monkeypatch):
+        monkeypatch.setattr(commit_mixin.random, 'random', lambda: 0.25)
+        policy = commit_mixin.ShedPolicy(max_pending=0, sample_rate=0.5)
+        session = self.FakeSession(shed_policy=policy)
+        calls = []
+        self.get_objects(session, calls)
+        session._do_after_commits()
+        assert calls == ['high', 'low']
+        assert not policy.shed
+
+    @pytest.mark.parametrize('time', ['before', 'failed'])
+    def test_only_after_shed(self, time):
+        policy = commit_mixin.ShedPolicy(max_pending=0)
+        session = self.FakeSession(shed_policy=policy)
+        calls = []
+        self.get_objects(session, calls, time)
+        getattr(session, f'_do_{time}_commits')()
+        assert calls == ['high', 'low']
+        assert not policy.shed
+
+
 def test_end_to_end():
     Base = declarative_base()
 
@@ -397,3 +491,94 @@ class TestCommitMixinHooks:
         session.rollback()
         data1.assert_failed_commit()
         data2.assert_failed_commit()
+
+
+class TestProcessDispatch:
+    class Data(Base, commit_mixin.CommitMixin):
+        __tablename__ = "data3"
+        id = Column(Integer, primary_key=True)
+        name = Column(String)
+        secret = Column(String)
+        commit_process_columns = ('name',)
+
+        def after_commit_from_insert(self):
+            return os.getpid(), self.id, self.name, self.secret
+
+        def after_commit_from_update(self):
+            raise ValueError(self.name)
+
+        def after_commit_from_delete(self):
+            return 'deleted', self.id
+
+    def get_session(self, executor):
+        engine = create_engine('sqlite:///:memory:')
+        self.Data.__table__.create(bind=engine)
+
+        SessionMaker = sessionmaker(class_=Session, bind=engine,
+                                    process_executor=executor)
+        return SessionMaker()
+
+    def test_build_payload(self):
+        session = self.get_session(None)
+        data = self.Data(id=3, name='a', secret='b')
+        session.add(data)
+        session.flush()
+
+        payload = commit_mixin._build_payload(data, 'insert')
+        assert payload.class_path == \
+            'sqlalchemy_commithooks.commit_mixin_test:TestProcessDispatch.Data'
+        assert payload.identity == (3,)
+        assert payload.action == 'insert'
+        assert payload.values == {'name': 'a'}
+
+    def test_run_payload(self):
+        payload = commit_mixin._HookPayload(
+            'sqlalchemy_commithooks.commit_mixin_test:TestProcessDispatch.Data',
+            (3,), 'insert', {'name': 'a'})
+        assert commit_mixin._run_payload(payload) == (os.getpid(), 3, 'a', None)
+
+    def test_process_pool(self):
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            session = self.get_session(executor)
+            data = self.Data(id=1, name='a', secret='b')
+            session.add(data)
+            session.commit()
+
+            futures = session.drain_hook_futures()
+            assert len(futures) == 1
+            pid, id_, name, secret = futures[0].result()
+            assert pid != os.getpid()
+            assert (id_, name, secret) == (1, 'a', None)
+            assert session.hook_futures == []
+
+            session.delete(data)
+            session.commit()
+            futures = session.drain_hook_futures()
+            assert len(futures) == 1
+            assert futures[0].result() == ('deleted', 1)
+
+    def test_futures_kept_until_drained(self):
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            session = self.get_session(executor)
+            session.add(self.Data(id=1, name='a'))
+            session.commit()
+            session.add(self.Data(id=2, name='b'))
+            session.commit()
+
+            futures = session.drain_hook_futures()
+            assert [f.result()[1] for f in futures] == [1, 2]
+
+    def test_worker_failure(self, caplog):
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            session = self.get_session(executor)
+            data = self.Data(id=1, name='a')
+            session.add(data)
+            session.commit()
+
+            data.name = 'broken'
+            session.commit()
+
+            futures = session.drain_hook_futures()
+            with pytest.raises(ValueError, match='broken'):
+                futures[1].result()
+        assert 'after_commit hook failed in worker process' in caplog.text